@@ -1,7 +1,11 @@
+import atexit
+import functools
 import sqlite3
 import pandas as pd
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 # --- Configuration ---
 DATABASE_PATH = os.path.join('nse_stocks.db')
@@ -12,146 +16,198 @@ TIME_PERIODS = {
     'annual': 'A'
 }
 
+# Compact column types for loaded price data; float32 is plenty of
+# precision for charting INR prices
+PRICE_DTYPES = {
+    'open': 'float32',
+    'high': 'float32',
+    'low': 'float32',
+    'close': 'float32',
+    'volume': 'int64'
+}
+
+# How each OHLCV column is combined when rolling up to a longer period
+AGG_LOGIC = {
+    'open': 'first',
+    'high': 'max',
+    'low': 'min',
+    'close': 'last',
+    'volume': 'sum'
+}
+
 def create_chart_directories():
     """
-    Ensures that the output directories for charts exist.
+    Ensures that the output directory for charts exists.
     """
-    if not os.path.exists(CHARTS_DIR):
-        os.makedirs(CHARTS_DIR)
-        
-    for period in TIME_PERIODS.keys():
-        period_path = os.path.join(CHARTS_DIR, period)
-        if not os.path.exists(period_path):
-            os.makedirs(period_path)
-    print("Chart directories are ready.")
+    os.makedirs(CHARTS_DIR, exist_ok=True)
+    print("Chart directory is ready.")
 
-def fetch_data_from_db():
+@functools.lru_cache(maxsize=None)
+def get_connection():
     """
-    Fetches all stock data and joins with stock info to get tickers and names.
-    Returns a pandas DataFrame.
+    Returns this process's single read connection to the database.
+    It is opened on first use and closed automatically when the program exits.
     """
-    if not os.path.exists(DATABASE_PATH):
-        print(f"Error: Database not found at {DATABASE_PATH}")
-        print("Please run '1_setup_database.py' and '2_fetch_data.py' first.")
-        return None
+    conn = sqlite3.connect(DATABASE_PATH, isolation_level=None)
+    atexit.register(conn.close)
+    return conn
 
-    print("Connecting to database and fetching all data...")
-    conn = sqlite3.connect(DATABASE_PATH)
-    
+def fetch_monthly_data_from_db(conn, stock_id):
+    """
+    Aggregates a single stock's daily prices into monthly OHLCV bars inside
+    SQLite, so only one row per month is transferred to pandas.
+    Each bar is dated at the end of its month, matching pandas' 'M' rule;
+    dates are parsed with an explicit ISO format to take the fast path.
+    Returns a date-indexed pandas DataFrame.
+    """
     query = """
+    WITH daily AS (
+        SELECT 
+            strftime('%Y-%m', date) AS period,
+            date, 
+            open, 
+            high, 
+            low, 
+            close, 
+            volume,
+            ROW_NUMBER() OVER (PARTITION BY strftime('%Y-%m', date) ORDER BY date) AS day_of_period,
+            ROW_NUMBER() OVER (PARTITION BY strftime('%Y-%m', date) ORDER BY date DESC) AS days_left_in_period
+        FROM stock_data
+        WHERE stock_id = ?
+    )
     SELECT 
-        s.ticker, 
-        s.company_name, 
-        d.date, 
-        d.open, 
-        d.high, 
-        d.low, 
-        d.close, 
-        d.volume
-    FROM stock_data d
-    JOIN stocks s ON s.id = d.stock_id
-    ORDER BY s.ticker, d.date
-    """
-    
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-    
-    if df.empty:
-        print("No data found in the database.")
-        return None
-        
-    # Convert date column to datetime objects for processing
-    df['date'] = pd.to_datetime(df['date'])
-    print(f"Successfully loaded {len(df)} rows of data for {df['ticker'].nunique()} stocks.")
-    return df
+        date(MIN(date), 'start of month', '+1 month', '-1 day') AS date,
+        MAX(CASE WHEN day_of_period = 1 THEN open END) AS open,
+        MAX(high) AS high,
+        MIN(low) AS low,
+        MAX(CASE WHEN days_left_in_period = 1 THEN close END) AS close,
+        SUM(volume) AS volume
+    FROM daily
+    GROUP BY period
+    ORDER BY period
+    """
+    
+    return pd.read_sql_query(query, conn, params=(stock_id,), index_col='date', parse_dates={'date': '%Y-%m-%d'}, dtype=PRICE_DTYPES)
 
-def aggregate_ohlcv(df, rule):
+def aggregate_ohlcv(df_indexed, rule):
     """
-    Aggregates daily OHLCV data to a different time frame (rule).
+    Aggregates date-indexed OHLCV data to a different time frame (rule).
     'rule' can be 'M' (Month), 'Q' (Quarter), 'A' (Annual).
+    Returns a date-indexed DataFrame.
     """
-    # Set the date as the index, which is required for resampling
-    df_indexed = df.set_index('date')
-    
-    # Define the aggregation logic
-    agg_logic = {
-        'open': 'first',
-        'high': 'max',
-        'low': 'min',
-        'close': 'last',
-        'volume': 'sum'
-    }
-    
-    # Resample the data
-    resampled_df = df_indexed.resample(rule).apply(agg_logic)
+    # Resample the data; agg() uses pandas' built-in group reducers
+    resampled_df = df_indexed.resample(rule).agg(AGG_LOGIC)
     
     # Drop any rows that are all empty (e.g., weekends/holidays with no data)
     resampled_df.dropna(how='all', inplace=True)
     
-    return resampled_df.reset_index()
+    return resampled_df
+
+def aggregate_all_timeframes(monthly_df):
+    """
+    Builds the bars for every time frame in TIME_PERIODS from date-indexed
+    monthly OHLCV data. Quarterly and annual bars are rolled up from the
+    monthly bars, which gives the same result as resampling the daily data
+    since first/max/min/last/sum all compose.
+    Returns a dict of timeframe -> DataFrame with a 'date' column.
+    """
+    aggregated = {}
+    for timeframe, rule in TIME_PERIODS.items():
+        if timeframe == 'monthly':
+            agg_df = monthly_df
+        else:
+            agg_df = aggregate_ohlcv(monthly_df, rule)
+        aggregated[timeframe] = agg_df.reset_index()
+    
+    return aggregated
 
 
-def create_candlestick_chart(df, ticker, company_name, timeframe):
+def create_candlestick_chart(aggregated, ticker, company_name):
     """
-    Creates an interactive Plotly candlestick chart and saves it as an HTML file.
+    Creates one interactive Plotly figure with a candlestick chart for every
+    time period, stacked vertically, and saves it as a single HTML file.
     """
-    fig = go.Figure(data=[go.Candlestick(x=df['date'],
-                                           open=df['open'],
-                                           high=df['high'],
-                                           low=df['low'],
-                                           close=df['close'])])
+    fig = make_subplots(rows=len(aggregated), cols=1,
+                        subplot_titles=[f"{timeframe.title()} Chart" for timeframe in aggregated])
+    
+    for row, df in enumerate(aggregated.values(), start=1):
+        fig.add_trace(go.Candlestick(x=df['date'],
+                                     open=df['open'],
+                                     high=df['high'],
+                                     low=df['low'],
+                                     close=df['close']),
+                      row=row, col=1)
     
     # Customize the chart layout
-    chart_title = f"{company_name} ({ticker}) - {timeframe.title()} Chart"
+    chart_title = f"{company_name} ({ticker})"
     fig.update_layout(
         title=chart_title,
-        yaxis_title='Stock Price (INR)',
-        xaxis_title='Date',
-        xaxis_rangeslider_visible=False, # Hide the range slider for a cleaner look
+        height=400 * len(aggregated),
+        showlegend=False,
         template='plotly_dark'
     )
+    fig.update_yaxes(title_text='Stock Price (INR)')
+    fig.update_xaxes(title_text='Date',
+                     rangeslider_visible=False) # Hide the range sliders for a cleaner look
     
     # Define the output file path
     filename = f"{ticker}.html"
-    save_path = os.path.join(CHARTS_DIR, timeframe, filename)
+    save_path = os.path.join(CHARTS_DIR, filename)
     
-    # Save the chart as an interactive HTML file
-    fig.write_html(save_path)
+    # Save the chart as an interactive HTML file.
+    # plotly.js is loaded from the CDN instead of being embedded in every file.
+    fig.write_html(save_path, include_plotlyjs='cdn', full_html=True)
     print(f"Saved chart: {save_path}")
 
+def render_stock_charts(stock_id, ticker, company_name):
+    """
+    Loads one stock's data and writes its chart covering every time period.
+    Runs in a worker process, using that worker's own database connection.
+    """
+    # Let SQLite build the monthly bars for just this one stock
+    monthly_df = fetch_monthly_data_from_db(get_connection(), stock_id)
+    
+    if monthly_df.empty:
+        print(f"No data found for {ticker}. Skipping.")
+        return
+    
+    print(f"\n--- Generating charts for: {company_name} ---")
+    
+    # 1. Aggregate the data for every time period at once
+    aggregated = aggregate_all_timeframes(monthly_df)
+    
+    # 2. Create and save one chart covering every time period
+    create_candlestick_chart(aggregated, ticker, company_name)
+
 def generate_all_charts():
     """
     Main function to run the entire chart generation process.
+    Each stock is rendered in its own worker process.
     """
     create_chart_directories()
     
-    master_df = fetch_data_from_db()
-    if master_df is None:
+    if not os.path.exists(DATABASE_PATH):
+        print(f"Error: Database not found at {DATABASE_PATH}")
+        print("Please run '1_setup_database.py' and '2_fetch_data.py' first.")
         return
 
-    # Get a list of all unique stocks in our dataset
-    stocks_to_chart = master_df['ticker'].unique()
-    
-    for ticker in stocks_to_chart:
-        # Get the company name (it's the same for all rows of this ticker)
-        company_name = master_df[master_df['ticker'] == ticker]['company_name'].iloc[0]
-        print(f"\n--- Generating charts for: {company_name} ---")
-        
-        # Get just the data for this one stock
-        stock_df = master_df[master_df['ticker'] == ticker].copy()
-        
-        # Loop through each time period (monthly, quarterly, annual)
-        for timeframe, rule in TIME_PERIODS.items():
-            
-            # 1. Aggregate the data
-            agg_df = aggregate_ohlcv(stock_df, rule)
-            
-            if agg_df.empty:
-                print(f"No aggregated data for {ticker} ({timeframe}). Skipping.")
-                continue
-            
-            # 2. Create and save the chart
-            create_candlestick_chart(agg_df, ticker, company_name, timeframe)
+    print("Connecting to database...")
+    conn = get_connection()
+    
+    # Get a list of all stocks in our dataset
+    stocks_to_chart = conn.execute("SELECT id, ticker, company_name FROM stocks ORDER BY ticker").fetchall()
+    
+    if not stocks_to_chart:
+        print("No stocks found in the database.")
+        return
+    
+    stock_ids, tickers, company_names = zip(*stocks_to_chart)
+    
+    # Chart rendering is CPU-bound and independent per stock, so fan it out across cores.
+    # Workers clear the connection cache on start-up so a forked worker opens its own
+    # connection instead of reusing the parent's.
+    with ProcessPoolExecutor(initializer=get_connection.cache_clear) as executor:
+        list(executor.map(render_stock_charts, stock_ids, tickers, company_names))
 
 # --- Main execution ---
 if __name__ == "__main__":
@@ -1,3 +1,5 @@
+import atexit
+import functools
 import sqlite3
 
 # Define the list of 20 NSE stocks we will track
@@ -27,22 +29,32 @@ STOCKS_TO_TRACK = [
 
 DATABASE_NAME = 'nse_stocks.db'
 
+@functools.lru_cache(maxsize=None)
+def get_connection():
+    """
+    Returns the single connection used for the whole setup run.
+    It is opened on first use (creating the database file if needed)
+    and closed automatically when the program exits.
+    """
+    conn = sqlite3.connect(DATABASE_NAME, isolation_level=None)
+    atexit.register(conn.close)
+    print(f"Successfully connected to {DATABASE_NAME}")
+    return conn
+
 def create_database():
     """
     Creates the initial database and the required tables: stocks and stock_data.
     """
     try:
         # Connect to the SQLite database (it will be created if it doesn't exist)
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = get_connection()
         cursor = conn.cursor()
-        
-        print(f"Successfully connected to {DATABASE_NAME}")
 
         # --- Create the 'stocks' table ---
         # This table will store the list of stocks we are tracking.
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS stocks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER PRIMARY KEY,
             ticker TEXT NOT NULL UNIQUE,
             company_name TEXT NOT NULL
         )
@@ -53,7 +65,7 @@ def create_database():
         # This table will store the daily price data for each stock.
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS stock_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER PRIMARY KEY,
             stock_id INTEGER NOT NULL,
             date DATE NOT NULL,
             open REAL NOT NULL,
@@ -67,25 +79,21 @@ def create_database():
         ''')
         print("Table 'stock_data' created or already exists.")
 
-        # Commit the changes and close the connection
-        conn.commit()
-        
     except sqlite3.Error as e:
         print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print(f"Connection to {DATABASE_NAME} closed.")
 
 def populate_stocks_table():
     """
     Inserts our list of 20 stocks into the 'stocks' table.
     Uses 'INSERT OR IGNORE' to avoid errors if a stock already exists.
     """
+    conn = get_connection()
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
         cursor = conn.cursor()
 
+        # Insert all stocks inside one explicit transaction
+        cursor.execute("BEGIN IMMEDIATE")
+
         # Insert the list of stocks
         # 'INSERT OR IGNORE' will skip inserting a row if the 'ticker' (which is UNIQUE) already exists.
         cursor.executemany('''
@@ -98,9 +106,8 @@ def populate_stocks_table():
         
     except sqlite3.Error as e:
         print(f"An error occurred while populating stocks: {e}")
-    finally:
-        if conn:
-            conn.close()
+        if conn.in_transaction:
+            conn.rollback()
 
 # --- Main execution ---
 if __name__ == "__main__":
@@ -1,3 +1,6 @@
+import atexit
+import functools
+import itertools
 import sqlite3
 import yfinance as yf
 import pandas as pd
@@ -11,24 +14,178 @@ DATABASE_PATH = os.path.join(DATABASE_NAME)
 # Define the start date for fetching historical data
 DATA_START_DATE = '2010-01-01'
 
+# Optionally also export each stock's prices as a columnar Parquet file
+# (requires pyarrow) for use by other tools. charts.py always reads SQLite.
+USE_PARQUET = False
+PARQUET_DIR = 'data'
+
+# Stocks whose resume dates are within this many days of the most recent
+# one share a single batched download; stocks further behind are fetched
+# separately so they don't pull the whole batch back to an old start date.
+SHARED_DOWNLOAD_WINDOW_DAYS = 14
+
+# Rows sent per multi-row INSERT statement. 7 values per row keeps each
+# statement under SQLite's older 999 bound-parameter limit.
+INSERT_BATCH_ROWS = 999 // 7
+
+def save_to_parquet(ticker, stock_id):
+    """
+    Writes one stock's full price history from SQLite to
+    PARQUET_DIR/<ticker>.parquet. The file is rewritten from the database
+    each time, so it never misses days stored while USE_PARQUET was off.
+    """
+    os.makedirs(PARQUET_DIR, exist_ok=True)
+    save_path = os.path.join(PARQUET_DIR, f"{ticker}.parquet")
+    
+    data = pd.read_sql_query('''
+    SELECT date, open, high, low, close, volume
+    FROM stock_data
+    WHERE stock_id = ?
+    ORDER BY date
+    ''', get_connection(), params=(stock_id,), parse_dates={'date': '%Y-%m-%d'})
+    
+    data.to_parquet(save_path, index=False, compression='zstd')
+    print(f"Saved Parquet file: {save_path}")
+
+def tune_sqlite(conn):
+    """
+    Applies PRAGMAs that speed up bulk inserts into the SQLite database.
+    """
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-200000")
+
+@functools.lru_cache(maxsize=None)
+def get_connection():
+    """
+    Returns the single tuned connection shared by the whole fetch run.
+    It is opened on first use and closed automatically when the program exits.
+    """
+    conn = sqlite3.connect(DATABASE_PATH, isolation_level=None)
+    tune_sqlite(conn)
+    atexit.register(conn.close)
+    return conn
+
 def get_stocks_from_db():
     """
-    Fetches the list of stocks (id, ticker) from the database.
+    Fetches the list of stocks (id, ticker, last stored date) from the database.
+    The last stored date is None for stocks with no price data yet.
     """
     if not os.path.exists(DATABASE_PATH):
         print(f"Error: Database file not found at {DATABASE_PATH}")
         print("Please run '1_setup_database.py' first.")
         return []
         
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT id, ticker FROM stocks")
+    cursor.execute('''
+    SELECT s.id, s.ticker, MAX(d.date)
+    FROM stocks s
+    LEFT JOIN stock_data d ON d.stock_id = s.id
+    GROUP BY s.id, s.ticker
+    ''')
     stocks = cursor.fetchall()
     
-    conn.close()
     return stocks
 
+def download_missing_data(stocks_list):
+    """
+    Downloads only the days each stock is missing from the database.
+    Stocks with similar resume dates are fetched together with one batched
+    yf.download call (which yfinance runs concurrently on its own thread
+    pool) from the earliest of those dates; rows a stock already has are
+    then dropped. Stocks that are far behind get a call of their own.
+    Returns a dict of ticker -> DataFrame of downloaded OHLCV data.
+    """
+    today = pd.Timestamp.today().normalize()
+    window = pd.Timedelta(days=SHARED_DOWNLOAD_WINDOW_DAYS)
+    
+    # Resume each stock from the day after its last stored date
+    last_dates = {ticker: last_date for _, ticker, last_date in stocks_list}
+    starts = {
+        ticker: pd.Timestamp(last_date) + pd.Timedelta(days=1) if last_date else pd.Timestamp(DATA_START_DATE)
+        for ticker, last_date in last_dates.items()
+    }
+    
+    # Group stocks, newest resume date first; a group's download starts at
+    # its earliest resume date
+    groups = []
+    for ticker, start in sorted(starts.items(), key=lambda item: item[1], reverse=True):
+        if start > today:
+            continue
+        if groups and groups[-1]['newest'] - start <= window:
+            groups[-1]['start'] = start
+            groups[-1]['tickers'].append(ticker)
+        else:
+            groups.append({'newest': start, 'start': start, 'tickers': [ticker]})
+    
+    if not groups:
+        print("All stocks are already up to date.")
+        return {}
+    
+    downloaded = {}
+    for group in groups:
+        tickers = group['tickers']
+        start = group['start'].strftime('%Y-%m-%d')
+        
+        print(f"Downloading data for {len(tickers)} stocks from {start}...")
+        batch = yf.download(
+            tickers,
+            start=start,
+            group_by='ticker',
+            threads=True,
+            progress=False,
+            # Store split/dividend-adjusted prices, matching the existing history
+            auto_adjust=True
+        )
+        
+        if batch.empty:
+            continue
+        
+        downloaded_tickers = batch.columns.get_level_values(0)
+        for ticker in tickers:
+            if ticker not in downloaded_tickers:
+                continue
+            
+            data = batch[ticker].dropna(how='all')
+            
+            # Drop the days this stock already has in the database
+            last_date = last_dates[ticker]
+            if last_date:
+                data = data[data.index > pd.Timestamp(last_date)]
+            
+            downloaded[ticker] = data
+    
+    return downloaded
+
+def insert_stock_rows(cursor, data_tuples):
+    """
+    Inserts (stock_id, date, open, high, low, close, volume) rows into
+    stock_data using multi-row VALUES statements of up to INSERT_BATCH_ROWS
+    rows each. Rows that already exist are ignored.
+    Returns the number of new rows inserted.
+    """
+    rows_inserted = 0
+    data_tuples = iter(data_tuples)
+    
+    while True:
+        batch = list(itertools.islice(data_tuples, INSERT_BATCH_ROWS))
+        if not batch:
+            break
+        
+        insert_query = f'''
+        INSERT OR IGNORE INTO stock_data 
+        (stock_id, date, open, high, low, close, volume) 
+        VALUES {', '.join(['(?, ?, ?, ?, ?, ?, ?)'] * len(batch))}
+        '''
+        
+        cursor.execute(insert_query, list(itertools.chain.from_iterable(batch)))
+        rows_inserted += cursor.rowcount
+    
+    return rows_inserted
+
 def fetch_and_insert_data():
     """
     Main function to fetch data for all stocks and insert into the database.
@@ -41,27 +198,33 @@ def fetch_and_insert_data():
 
     print(f"Found {len(stocks_list)} stocks to process. Starting data download...")
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    ticker_ids = {ticker: stock_id for stock_id, ticker, _ in stocks_list}
+    downloaded = download_missing_data(stocks_list)
+    
+    conn = get_connection()
     cursor = conn.cursor()
     
     total_rows_inserted = 0
     
     try:
-        for stock_id, ticker in stocks_list:
+        # Insert every ticker's rows inside one explicit transaction
+        cursor.execute("BEGIN IMMEDIATE")
+        
+        for ticker, stock_id in ticker_ids.items():
             print(f"\n--- Processing: {ticker} (ID: {stock_id}) ---")
             
-            # 1. Fetch data from yfinance
+            # 1. Take this ticker's data from the batched download
             try:
-                data = yf.download(ticker, start=DATA_START_DATE, progress=False)
+                data = downloaded.get(ticker)
                 
-                if data.empty:
-                    print(f"No data found for {ticker}. Skipping.")
+                if data is None or data.empty:
+                    print(f"No new data found for {ticker}. Skipping.")
                     continue
                     
                 print(f"Downloaded {len(data)} data points for {ticker}.")
 
                 # 2. Clean and format the data
-                data.reset_index(inplace=True)
+                data = data.reset_index()
                 
                 # Rename columns to match our database schema
                 data.rename(columns={
@@ -77,7 +240,7 @@ def fetch_and_insert_data():
                 data = data[['date', 'open', 'high', 'low', 'close', 'volume']]
                 
                 # Drop any rows with missing data
-                data.dropna(inplace=True)
+                data = data.dropna()
                 
                 # Add the stock_id to each row for insertion
                 data['stock_id'] = stock_id
@@ -85,30 +248,34 @@ def fetch_and_insert_data():
                 # Convert 'date' to a string in 'YYYY-MM-DD' format
                 data['date'] = data['date'].dt.strftime('%Y-%m-%d')
                 
-                # Reorder columns for insertion
-                data_tuples = [tuple(x) for x in data[['stock_id', 'date', 'open', 'high', 'low', 'close', 'volume']].values]
+                # Reorder columns for insertion; itertuples yields plain tuples
+                # lazily instead of materializing a list of per-row tuples
+                data_tuples = data[['stock_id', 'date', 'open', 'high', 'low', 'close', 'volume']].itertuples(index=False, name=None)
 
                 # 3. Insert data into the database
-                insert_query = '''
-                INSERT OR IGNORE INTO stock_data 
-                (stock_id, date, open, high, low, close, volume) 
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                '''
+                rows_inserted = insert_stock_rows(cursor, data_tuples)
                 
-                cursor.executemany(insert_query, data_tuples)
-                conn.commit()
+                print(f"Successfully inserted {rows_inserted} new rows for {ticker}.")
+                total_rows_inserted += rows_inserted
                 
-                print(f"Successfully inserted {cursor.rowcount} new rows for {ticker}.")
-                total_rows_inserted += cursor.rowcount
+                # 4. Optionally mirror the stock's prices to Parquet. This store is
+                # secondary, so a failure here is only reported.
+                if USE_PARQUET:
+                    try:
+                        save_to_parquet(ticker, stock_id)
+                    except Exception as e:
+                        print(f"Could not save Parquet file for {ticker}: {e}")
 
             except Exception as e:
                 print(f"An error occurred while processing {ticker}: {e}")
+        
+        # Commit all tickers in a single transaction
+        conn.commit()
                 
     except sqlite3.Error as e:
         print(f"A database error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
+        if conn.in_transaction:
+            conn.rollback()
             
     print("\n--- ✅ Data fetching complete! ---")
     print(f"Total new rows inserted across all stocks: {total_rows_inserted}")